@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+Aggregate fingerprint matches per country, ASN and day
+
+This consumes the output of batch_match_fingerprints.match_column together
+with the probe_cc, probe_asn and day columns of the same measurements and
+only keeps a count per (cc, asn, day, fingerprint) group, so memory grows
+with the number of distinct groups rather than with the number of
+measurements. Aggregators built by parallel workers can be merged.
+"""
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from fingerprints import Fingerprint
+from batch_match_fingerprints import NO_MATCH
+
+# Group by columns which are integer coded through a category dictionary, the
+# fingerprint column is already an index into the fingerprint list
+CATEGORIES = ("probe_cc", "probe_asn", "day")
+
+
+def _none_last(value):
+    return (value is None, "" if value is None else value)
+
+
+class FingerprintAggregator:
+    def __init__(self, fingerprints: List[Fingerprint]):
+        self.fingerprints = fingerprints
+        # value -> code and code -> value for every category
+        self.codes = {name: {} for name in CATEGORIES}
+        self.values = {name: [] for name in CATEGORIES}
+        # one row of (probe_cc, probe_asn, day, fingerprint) codes per group
+        self.keys = np.empty((0, len(CATEGORIES) + 1), dtype=np.int64)
+        self.counts = np.empty(0, dtype=np.int64)
+
+    def _encode(self, name: str, values) -> np.ndarray:
+        """
+        Return the codes of the distinct values of a category, adding the
+        values not seen before to its dictionary
+        """
+        codes = self.codes[name]
+        decoded = self.values[name]
+        result = np.empty(len(values), dtype=np.int64)
+        for i, value in enumerate(values):
+            value = value.item() if isinstance(value, np.generic) else value
+            code = codes.get(value)
+            if code is None:
+                code = codes[value] = len(decoded)
+                decoded.append(value)
+            result[i] = code
+        return result
+
+    def _encode_column(self, name: str, column: np.ndarray) -> np.ndarray:
+        """
+        Return the codes of every value of a column. Missing values (None)
+        are coded separately, as they cannot be sorted by np.unique.
+        """
+        missing = np.equal(column, None) if column.dtype == object else np.zeros(len(column), dtype=bool)
+        result = np.empty(len(column), dtype=np.int64)
+        if missing.any():
+            result[missing] = self._encode(name, [None])[0]
+        if not missing.all():
+            uniq, inverse = np.unique(column[~missing], return_inverse=True)
+            result[~missing] = self._encode(name, uniq)[inverse.reshape(-1)]
+        return result
+
+    def _add(self, keys: np.ndarray, counts: np.ndarray) -> None:
+        keys = np.concatenate((self.keys, keys))
+        counts = np.concatenate((self.counts, counts))
+        self.keys, inverse = np.unique(keys, axis=0, return_inverse=True)
+        self.counts = np.zeros(len(self.keys), dtype=np.int64)
+        np.add.at(self.counts, inverse.reshape(-1), counts)
+
+    def update(self, probe_cc, probe_asn, day, fp_indices) -> None:
+        """
+        Add a batch of measurements. All arguments are columns of the same
+        length, fp_indices holds -1 for measurements without a match.
+        """
+        fp_indices = np.asarray(fp_indices, dtype=np.int64).reshape(-1)
+        columns = [np.asarray(c).reshape(-1) for c in (probe_cc, probe_asn, day)]
+        lengths = [len(c) for c in columns]
+        if any(length != len(fp_indices) for length in lengths):
+            raise ValueError(
+                f"Columns have different lengths: probe_cc, probe_asn, day "
+                f"have {lengths}, fp_indices has {len(fp_indices)}"
+            )
+        matched = fp_indices != NO_MATCH
+        fp_indices = fp_indices[matched]
+        if len(fp_indices) == 0:
+            return
+        if fp_indices.min() < 0 or fp_indices.max() >= len(self.fingerprints):
+            raise ValueError("fp_indices out of range of the fingerprint list")
+
+        # Only the distinct values of each column go through the category
+        # dictionaries, the rows are then counted per group in one go
+        keys = [
+            self._encode_column(name, column[matched])
+            for name, column in zip(CATEGORIES, columns)
+        ]
+        keys.append(fp_indices)
+        keys, counts = np.unique(np.stack(keys, axis=1), axis=0, return_counts=True)
+        self._add(keys, counts.astype(np.int64))
+
+    def merge(self, other: "FingerprintAggregator") -> "FingerprintAggregator":
+        if other.fingerprints is not self.fingerprints and other.fingerprints != self.fingerprints:
+            raise ValueError("Cannot merge aggregators built on different fingerprint lists")
+        keys = other.keys.copy()
+        for i, name in enumerate(CATEGORIES):
+            # map the codes of other onto the codes of self
+            remap = self._encode(name, other.values[name])
+            keys[:, i] = remap[keys[:, i]]
+        self._add(keys, other.counts)
+        return self
+
+    def is_unexpected(self, cc: Optional[str], fp_idx: int) -> bool:
+        """
+        A hit is unexpected when the fingerprint lists expected_countries and
+        cc is not among them. ZZ means the fingerprint can be seen anywhere and
+        a missing cc is never flagged.
+        """
+        expected = [c for c in self.fingerprints[fp_idx].expected_countries if c]
+        if cc is None or not expected or "ZZ" in expected:
+            return False
+        return cc not in expected
+
+    def rows(self) -> List[Dict[str, Any]]:
+        """
+        Return the aggregate as a table sorted by day, cc, asn and fingerprint
+        name
+        """
+        cc_values, asn_values, day_values = (self.values[name] for name in CATEGORIES)
+        rows = []
+        for (cc_code, asn_code, day_code, fp_idx), count in zip(self.keys.tolist(), self.counts.tolist()):
+            cc = cc_values[cc_code]
+            rows.append(
+                dict(
+                    probe_cc=cc,
+                    probe_asn=asn_values[asn_code],
+                    day=day_values[day_code],
+                    fingerprint=self.fingerprints[fp_idx].name,
+                    count=count,
+                    unexpected_country=self.is_unexpected(cc, fp_idx),
+                )
+            )
+        return sorted(
+            rows,
+            key=lambda r: tuple(
+                _none_last(r[k]) for k in ("day", "probe_cc", "probe_asn", "fingerprint")
+            ),
+        )
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+Vectorized matching of columnar measurement data against the fingerprints
+
+Columns are anything numpy.asarray accepts (lists, numpy arrays, pyarrow
+arrays) holding the values found at a given location_found, for example all
+the Server headers or all the DNS answers of a batch of measurements. The
+result is a column of indices into the list of fingerprints, with -1 where
+no fingerprint matched. When more than one fingerprint matches a value the
+one with the lowest index wins, mirroring the order of the CSV files.
+"""
+from typing import Dict, List
+
+import numpy as np
+
+from fingerprints import Fingerprint
+from match_fingerprints import compile_regexp
+
+NO_MATCH = -1
+
+# Upper bound on the number of characters of the fixed width string arrays
+# built for the contains matching, every value is padded to the longest one
+# of its chunk
+CHUNK_CHARS = 1 << 20
+
+
+def _first_by_pattern(patterns: np.ndarray, indices: np.ndarray):
+    """
+    Sort patterns and keep, for each distinct pattern, the lowest fingerprint
+    index
+    """
+    order = np.lexsort((indices, patterns))
+    patterns, indices = patterns[order], indices[order]
+    patterns, first = np.unique(patterns, return_index=True)
+    return patterns.astype(object), indices[first]
+
+
+def _match_full(uniq, best, patterns, indices) -> None:
+    patterns, indices = _first_by_pattern(patterns, indices)
+    pos = np.searchsorted(patterns, uniq)
+    pos[pos == len(patterns)] = 0
+    found = patterns[pos] == uniq
+    np.minimum.at(best, np.nonzero(found)[0], indices[pos[found]])
+
+
+def _match_prefix(uniq, best, patterns, indices) -> None:
+    # uniq is sorted, so every value starting with a given prefix lies in a
+    # contiguous range right after the prefix itself
+    lo = np.searchsorted(uniq, patterns, side="left")
+    upper = np.array([p + "\U0010ffff" for p in patterns], dtype=object)
+    hi = np.searchsorted(uniq, upper, side="left")
+    for start, end, idx in zip(lo, hi, indices):
+        if start < end:
+            np.minimum(best[start:end], idx, out=best[start:end])
+
+
+def _chunks_by_width(uniq):
+    """
+    Split the positions of uniq in chunks of values of similar length, each
+    one holding at most CHUNK_CHARS characters once padded, so that a single
+    long value does not blow up the whole array
+    """
+    lengths = np.fromiter(map(len, uniq), np.int64, len(uniq))
+    order = np.argsort(lengths, kind="stable")
+    start = 0
+    while start < len(order):
+        end = start + 1
+        while end < len(order) and (end - start + 1) * lengths[order[end]] <= CHUNK_CHARS:
+            end += 1
+        yield order[start:end]
+        start = end
+
+
+def _match_contains(uniq, best, patterns, indices) -> None:
+    for chunk in _chunks_by_width(uniq):
+        values = uniq[chunk].astype(str)
+        chunk_best = best[chunk]
+        for pattern, idx in zip(patterns, indices):
+            found = np.char.find(values, pattern) >= 0
+            np.minimum(chunk_best, np.where(found, idx, chunk_best), out=chunk_best)
+        best[chunk] = chunk_best
+
+
+def _match_regexp(uniq, best, patterns, indices) -> None:
+    for pattern, idx in zip(patterns, indices):
+        search = compile_regexp(str(pattern)).search
+        found = np.fromiter((search(v) is not None for v in uniq), bool, len(uniq))
+        np.minimum(best, np.where(found, idx, best), out=best)
+
+
+_matchers = {
+    "full": _match_full,
+    "prefix": _match_prefix,
+    "contains": _match_contains,
+    "regexp": _match_regexp,
+}
+
+
+def match_column(
+    fingerprints: List[Fingerprint], location_found: str, column
+) -> np.ndarray:
+    """
+    Match every value of column against the fingerprints found at
+    location_found. Missing values (None) never match.
+    """
+    values = np.asarray(column, dtype=object).reshape(-1)
+    missing = np.equal(values, None)
+
+    # Each distinct value is only matched once. The values are kept as
+    # Python strings, as a fixed width array would pad every row to the
+    # longest value of the column.
+    uniq, inverse = np.unique(values[~missing], return_inverse=True)
+    sentinel = len(fingerprints)
+    best = np.full(len(uniq), sentinel, dtype=np.int64)
+
+    for pattern_type, matcher in _matchers.items():
+        selected = [
+            idx
+            for idx, fp in enumerate(fingerprints)
+            if fp.location_found == location_found and fp.pattern_type == pattern_type
+        ]
+        if not selected or len(uniq) == 0:
+            continue
+        patterns = np.array([fingerprints[idx].pattern for idx in selected], dtype=str)
+        matcher(uniq, best, patterns, np.array(selected, dtype=np.int64))
+
+    best[best == sentinel] = NO_MATCH
+    result = np.full(len(values), NO_MATCH, dtype=np.int64)
+    result[~missing] = best[inverse.reshape(-1)]
+    return result
+
+
+def match_columns(
+    fingerprints: List[Fingerprint], columns: Dict[str, object]
+) -> Dict[str, np.ndarray]:
+    """
+    Match several columns at once, columns is keyed by location_found (ex.
+    header.server, header.location or dns)
+    """
+    return {
+        location_found: match_column(fingerprints, location_found, column)
+        for location_found, column in columns.items()
+    }
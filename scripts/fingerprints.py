@@ -0,0 +1,48 @@
+"""
+Fingerprint model and loading of the CSV fingerprint databases
+"""
+from dataclasses import field, dataclass
+from typing import Optional, List
+import csv
+
+HTTP_CSV = "fingerprints_http.csv"
+DNS_CSV = "fingerprints_dns.csv"
+
+
+@dataclass
+class Fingerprint:
+    name: str
+    pattern: str
+    pattern_type: str
+    location_found: str
+    exp_url: Optional[str] = ""
+    confidence_no_fp: Optional[int] = 5
+    source: List[Optional[str]] = field(default_factory=list)
+    scope: Optional[str] = ""
+    notes: Optional[str] = ""
+    expected_countries: Optional[List[str]] = field(default_factory=list)
+    other_names: Optional[List[str]] = field(default_factory=list)
+
+
+def csv_row_to_fp(row):
+    return Fingerprint(
+        name=row["name"],
+        pattern=row["pattern"],
+        pattern_type=row["pattern_type"],
+        location_found=row["location_found"],
+        confidence_no_fp=int(row["confidence_no_fp"]),
+        source=row["source"].split(","),
+        scope=row["scope"],
+        exp_url=row["exp_url"],
+        notes=row["notes"],
+        expected_countries=row["expected_countries"].split(","),
+        other_names=row["other_names"].split(","),
+    )
+
+def load_fps(csv_path: str) -> List[Fingerprint]:
+    with open(csv_path, "r", encoding="utf-8", newline="") as in_file:
+        reader = csv.DictReader(in_file)
+        return [csv_row_to_fp(row) for row in reader]
+
+def load_existing_fps(http_path: str = HTTP_CSV, dns_path: str = DNS_CSV):
+    return load_fps(http_path) + load_fps(dns_path)
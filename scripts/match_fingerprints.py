@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+Match HTTP and DNS responses against the fingerprint databases
+
+HTTP matching is split in two phases so that probes can stop downloading a
+response body as soon as the headers alone identify a blockpage:
+
+    verdict = match_headers(fingerprints, status_code, headers)
+    if verdict.conclusive is None:
+        matches = match_body(verdict.body_fingerprints, body)
+"""
+import re
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Dict, List, Optional
+
+from fingerprints import Fingerprint
+
+# National, ISP and product blockpage fingerprints are decisive on their own
+# once their confidence_no_fp is at least CONCLUSIVE_CONFIDENCE
+CONCLUSIVE_SCOPES = ("nat", "isp", "prod")
+CONCLUSIVE_CONFIDENCE = 5
+
+# Fingerprints of other scopes need a confidence above the default one
+OTHER_CONCLUSIVE_CONFIDENCE = 6
+
+# False positive fingerprints and vague blocking words are never decisive
+NON_CONCLUSIVE_SCOPES = ("fp", "vbw")
+
+# Status codes for which an HTTP response never carries a body
+NO_BODY_STATUS_CODES = (204, 304)
+
+
+@dataclass
+class HeaderVerdict:
+    # header fingerprints matching the response
+    matches: List[Fingerprint] = field(default_factory=list)
+    # first match that is decisive on its own, if any. It's never set when
+    # a fp fingerprint matched, as that is evidence against a blockpage.
+    conclusive: Optional[Fingerprint] = None
+    # body fingerprints that could still change the verdict, empty when
+    # conclusive
+    body_fingerprints: List[Fingerprint] = field(default_factory=list)
+
+
+@lru_cache(maxsize=None)
+def compile_regexp(pattern: str) -> re.Pattern:
+    return re.compile(pattern)
+
+
+def match_pattern(fp: Fingerprint, value: str) -> bool:
+    if fp.pattern_type == "full":
+        return value == fp.pattern
+    if fp.pattern_type == "prefix":
+        return value.startswith(fp.pattern)
+    if fp.pattern_type == "contains":
+        return fp.pattern in value
+    if fp.pattern_type == "regexp":
+        return compile_regexp(fp.pattern).search(value) is not None
+    raise Exception(f"Unsupported pattern_type {fp.pattern_type}")
+
+
+def is_conclusive(fp: Fingerprint, min_confidence: int = CONCLUSIVE_CONFIDENCE) -> bool:
+    if fp.scope in NON_CONCLUSIVE_SCOPES:
+        return False
+    if fp.scope not in CONCLUSIVE_SCOPES:
+        min_confidence = max(min_confidence, OTHER_CONCLUSIVE_CONFIDENCE)
+    return int(fp.confidence_no_fp) >= min_confidence
+
+
+def match_headers(
+    fingerprints: List[Fingerprint],
+    status_code: Optional[int],
+    headers: Dict[str, str],
+    min_confidence: int = CONCLUSIVE_CONFIDENCE,
+) -> HeaderVerdict:
+    """
+    Phase one: evaluate the status line and the header.* fingerprints.
+    Header names are matched case-insensitively.
+
+    The verdict on a response depends on whether any fp fingerprint, any
+    other fingerprint and any conclusive fingerprint matched, so only the
+    body fingerprints which can still flip one of these are returned:
+    * once a fp fingerprint matched, body fp fingerprints add nothing and
+      no match can be conclusive anymore
+    * once another fingerprint matched, body fingerprints only matter if
+      they are fp or conclusive
+    """
+    headers = {k.lower(): v for k, v in headers.items()}
+    verdict = HeaderVerdict()
+    for fp in fingerprints:
+        if not fp.location_found.startswith("header."):
+            continue
+        value = headers.get(fp.location_found[len("header."):])
+        if value is None or not match_pattern(fp, value):
+            continue
+        verdict.matches.append(fp)
+
+    has_fp = any(fp.scope == "fp" for fp in verdict.matches)
+    has_blocking = any(fp.scope != "fp" for fp in verdict.matches)
+    if not has_fp:
+        verdict.conclusive = next(
+            (fp for fp in verdict.matches if is_conclusive(fp, min_confidence)),
+            None,
+        )
+
+    if verdict.conclusive is not None or status_code in NO_BODY_STATUS_CODES:
+        return verdict
+
+    for fp in fingerprints:
+        if fp.location_found != "body":
+            continue
+        if fp.scope == "fp":
+            worth_checking = not has_fp
+        else:
+            worth_checking = not has_blocking or (
+                not has_fp and is_conclusive(fp, min_confidence)
+            )
+        if worth_checking:
+            verdict.body_fingerprints.append(fp)
+    return verdict
+
+
+def match_body(fingerprints: List[Fingerprint], body: str) -> List[Fingerprint]:
+    """
+    Phase two: evaluate the body against the fingerprints left over by
+    match_headers.
+    """
+    return [
+        fp
+        for fp in fingerprints
+        if fp.location_found == "body" and match_pattern(fp, body)
+    ]
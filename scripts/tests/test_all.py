@@ -2,7 +2,14 @@ import unittest
 import json
 import csv
 import os
+import tracemalloc
+from pathlib import Path
 from update_fingerprints import unescape_regexp
+from fingerprints import Fingerprint, load_fps
+from match_fingerprints import match_headers, match_body
+from batch_match_fingerprints import match_columns
+from aggregate_fingerprints import FingerprintAggregator
+from validate_csv import validate_csvs
 
 class Test(unittest.TestCase):
     def test_fp_gen(self):
@@ -40,3 +47,173 @@ class Test(unittest.TestCase):
                 assert row == before_rows[idx], f"ERR: {row} != {before_rows[idx]}"
 
         os.unlink("tests/test-out.csv")
+
+    def test_two_phase_match(self):
+        fps = [
+            Fingerprint(name="ooni.ae_0", scope="nat", location_found="header.server", pattern_type="prefix", pattern="Protected by WireFilter"),
+            Fingerprint(name="cp.fp_location", scope="fp", location_found="header.location", pattern_type="prefix", pattern="http://example.com/"),
+            Fingerprint(name="cp.body", scope="isp", location_found="body", pattern_type="regexp", pattern="blocked.*site"),
+            Fingerprint(name="cp.dns", scope="isp", location_found="dns", pattern_type="full", pattern="10.10.34.34"),
+        ]
+
+        verdict = match_headers(fps, 403, {"Server": "Protected by WireFilter 8000"})
+        assert verdict.conclusive.name == "ooni.ae_0"
+        assert verdict.body_fingerprints == []
+
+        verdict = match_headers(fps, 302, {"Location": "http://example.com/x"})
+        assert [fp.name for fp in verdict.matches] == ["cp.fp_location"]
+        assert verdict.conclusive is None
+        assert [fp.name for fp in verdict.body_fingerprints] == ["cp.body"]
+        matches = match_body(verdict.body_fingerprints, "this site is blocked, the site")
+        assert [fp.name for fp in matches] == ["cp.body"]
+
+        verdict = match_headers(fps, 304, {})
+        assert verdict.conclusive is None
+        assert verdict.body_fingerprints == []
+
+    def test_batch_match(self):
+        fps = [
+            Fingerprint(name="ooni.ae_0", scope="nat", location_found="header.server", pattern_type="prefix", pattern="Protected by WireFilter"),
+            Fingerprint(name="ooni.ae_2", scope="isp", location_found="header.location", pattern_type="prefix", pattern="http://lighthouse.du.ae"),
+            Fingerprint(name="cp.location", scope="isp", location_found="header.location", pattern_type="contains", pattern="blocked"),
+            Fingerprint(name="ooni.by_4", scope="isp", location_found="dns", pattern_type="full", pattern="134.17.0.7"),
+        ]
+        result = match_columns(fps, {
+            "header.server": ["nginx", "Protected by WireFilter 8000", None, "nginx"],
+            "header.location": ["http://lighthouse.du.ae/blocked", "http://x.com/blocked", "http://lighthouse.du", ""],
+            "dns": ["134.17.0.7", "134.17.0.70", "134.17.0.7"],
+        })
+        assert result["header.server"].tolist() == [-1, 0, -1, -1]
+        assert result["header.location"].tolist() == [1, 2, -1, -1]
+        assert result["dns"].tolist() == [3, -1, 3]
+
+    def test_batch_match_long_value(self):
+        fps = [
+            Fingerprint(name="ooni.ae_2", scope="isp", location_found="header.location", pattern_type="prefix", pattern="http://lighthouse.du.ae"),
+            Fingerprint(name="cp.location", scope="isp", location_found="header.location", pattern_type="contains", pattern="blocked"),
+        ]
+        column = [f"http://example.com/{i}" for i in range(20000)]
+        column.append("http://lighthouse.du.ae/" + "a" * 4096)
+        column.append("http://example.com/blocked/" + "a" * 4096)
+
+        tracemalloc.start()
+        result = match_columns(fps, {"header.location": column})["header.location"]
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        assert result[:-2].tolist() == [-1] * 20000
+        assert result[-2:].tolist() == [0, 1]
+        # padding every row to the longest value would take over 300MB
+        assert peak < 50 * 1024 * 1024, peak
+
+    def test_aggregate(self):
+        fps = [
+            Fingerprint(name="ooni.ir_0", scope="nat", location_found="body", pattern_type="contains", pattern="iframe", expected_countries=["IR"]),
+            Fingerprint(name="cl.vbw", scope="vbw", location_found="body", pattern_type="contains", pattern="blocked", expected_countries=[""]),
+        ]
+        a = FingerprintAggregator(fps)
+        a.update(["IR", "IR", "IT", "IR"], [197207, 197207, 30722, 197207], ["2022-01-01"] * 4, [0, 0, 0, -1])
+        b = FingerprintAggregator(fps)
+        b.update(["IR", "IT"], [197207, 30722], ["2022-01-01", "2022-01-02"], [0, 1])
+        b.update(["IR"], [197207], ["2022-01-01"], [-1])
+        rows = a.merge(b).rows()
+        assert rows == [
+            dict(probe_cc="IR", probe_asn=197207, day="2022-01-01", fingerprint="ooni.ir_0", count=3, unexpected_country=False),
+            dict(probe_cc="IT", probe_asn=30722, day="2022-01-01", fingerprint="ooni.ir_0", count=1, unexpected_country=True),
+            dict(probe_cc="IT", probe_asn=30722, day="2022-01-02", fingerprint="cl.vbw", count=1, unexpected_country=False),
+        ]
+
+        with self.assertRaises(ValueError):
+            a.update(["IR"], [197207, 197207], ["2022-01-01"] * 2, [0, 0])
+
+        zz_fps = fps + [
+            Fingerprint(name="ooni.zz_4", scope="isp", location_found="dns", pattern_type="full", pattern="127.0.0.1", expected_countries=["ZZ"]),
+            Fingerprint(name="ooni.gr_1", scope="isp", location_found="dns", pattern_type="full", pattern="127.0.0.2", expected_countries=["GR", "ZZ"]),
+        ]
+        c = FingerprintAggregator(zz_fps)
+        c.update(["US", "US", None, None], [7922, 7922, None, 30722], ["2022-01-01"] * 4, [2, 3, 0, 0])
+        assert c.rows() == [
+            dict(probe_cc="US", probe_asn=7922, day="2022-01-01", fingerprint="ooni.gr_1", count=1, unexpected_country=False),
+            dict(probe_cc="US", probe_asn=7922, day="2022-01-01", fingerprint="ooni.zz_4", count=1, unexpected_country=False),
+            dict(probe_cc=None, probe_asn=30722, day="2022-01-01", fingerprint="ooni.ir_0", count=1, unexpected_country=False),
+            dict(probe_cc=None, probe_asn=None, day="2022-01-01", fingerprint="ooni.ir_0", count=1, unexpected_country=False),
+        ]
+        with self.assertRaises(ValueError):
+            a.merge(FingerprintAggregator(fps[:1]))
+
+    def test_validate_csv(self):
+        header = "name,scope,other_names,location_found,pattern_type,pattern,confidence_no_fp,expected_countries,source,exp_url,notes\n"
+        with open("tests/test-http.csv", "w", encoding="utf-8") as out_file:
+            out_file.write(header)
+            out_file.write('ooni.a,nat,ooni.c,body,contains,"multi\nline",5,"IT,IR",ooni,,\n')
+            out_file.write("ooni.b,bad,,body,regexp,(,5,XX,ooni,,\n")
+        with open("tests/test-dns.csv", "w", encoding="utf-8") as out_file:
+            out_file.write(header)
+            out_file.write("ooni.a,nat,,dns,full,10.0.0.1,5,,ooni,,\n")
+            out_file.write("ooni.c,nat,,dns,full,10.0.0.2,5,,ooni,,\n")
+
+        result = validate_csvs([Path("tests/test-dns.csv"), Path("tests/test-http.csv")])
+        os.unlink("tests/test-http.csv")
+        os.unlink("tests/test-dns.csv")
+
+        errors = [(e.path, e.line) for e in result.errors]
+        assert result.rows == 4
+        assert not result.ok
+        assert errors == [
+            ("tests/test-http.csv", 2),
+            ("tests/test-http.csv", 2),
+            ("tests/test-http.csv", 4),
+            ("tests/test-http.csv", 4),
+            ("tests/test-http.csv", 4),
+        ], result.errors
+        assert "Invalid regexp" in result.errors[-1].message
+        assert result.warnings == []
+        assert any("other_names entry ooni.c" in e.message for e in result.errors)
+
+    def test_two_phase_real_fingerprints(self):
+        fps = load_fps("../fingerprints_http.csv")
+        verdict = match_headers(fps, 403, {"Server": "Protected by WireFilter 8000"})
+        assert verdict.conclusive.name == "ooni.ae_0"
+        assert verdict.body_fingerprints == []
+
+        verdict = match_headers(fps, 302, {"Location": "http://lighthouse.du.ae/index.html"})
+        assert verdict.conclusive.name == "ooni.ae_2"
+
+    def test_two_phase_reduction(self):
+        fps = [
+            Fingerprint(name="cl.nat", scope="nat", location_found="header.server", pattern_type="full", pattern="nat", confidence_no_fp=10),
+            Fingerprint(name="cl.vbw", scope="vbw", location_found="header.server", pattern_type="full", pattern="vbw", confidence_no_fp=10),
+            Fingerprint(name="cl.inst", scope="inst", location_found="header.server", pattern_type="full", pattern="inst"),
+            Fingerprint(name="cp.vbw_location", scope="vbw", location_found="header.location", pattern_type="prefix", pattern="http://isp/"),
+            Fingerprint(name="cp.fp", scope="fp", location_found="header.location", pattern_type="prefix", pattern="http://fp/"),
+            Fingerprint(name="body.fp", scope="fp", location_found="body", pattern_type="contains", pattern="a"),
+            Fingerprint(name="body.weak", scope="vbw", location_found="body", pattern_type="contains", pattern="b"),
+            Fingerprint(name="body.strong", scope="nat", location_found="body", pattern_type="contains", pattern="c", confidence_no_fp=10),
+        ]
+
+        def names(l):
+            return [fp.name for fp in l]
+
+        # vague blocking words are never conclusive
+        verdict = match_headers(fps, 200, {"Server": "vbw"})
+        assert verdict.conclusive is None
+
+        # institution blockpages need a confidence above the default
+        verdict = match_headers(fps, 200, {"Server": "inst"})
+        assert names(verdict.matches) == ["cl.inst"]
+        assert verdict.conclusive is None
+
+        # a fp match prevents a conclusive verdict
+        verdict = match_headers(fps, 302, {"Server": "nat", "Location": "http://fp/"})
+        assert names(verdict.matches) == ["cl.nat", "cp.fp"]
+        assert verdict.conclusive is None
+        assert verdict.body_fingerprints == []
+
+        verdict = match_headers(fps, 200, {})
+        assert names(verdict.body_fingerprints) == ["body.fp", "body.weak", "body.strong"]
+
+        verdict = match_headers(fps, 302, {"Location": "http://isp/"})
+        assert names(verdict.body_fingerprints) == ["body.fp", "body.strong"]
+
+        verdict = match_headers(fps, 302, {"Location": "http://fp/"})
+        assert names(verdict.body_fingerprints) == ["body.weak", "body.strong"]
@@ -2,11 +2,13 @@ import io
 import re
 import json
 import ast
-from dataclasses import field, asdict, dataclass
+from dataclasses import asdict
 from typing import Any, Dict, Optional, List
 import requests
 import csv
 
+from fingerprints import Fingerprint, load_existing_fps
+
 CP_FINGERPRINTS_CP = "https://raw.githubusercontent.com/censoredplanet/censoredplanet-analysis/master/pipeline/metadata/data/blockpage_signatures.json"
 CP_FALSE_POSITIVE_CP = "https://raw.githubusercontent.com/censoredplanet/censoredplanet-analysis/master/pipeline/metadata/data/false_positive_signatures.json"
 CL_DNS = "https://raw.githubusercontent.com/citizenlab/filtering-annotations/master/data/v1/dns.csv"
@@ -45,20 +47,6 @@ csv_header_fields = [
     "notes"
 ]
 
-@dataclass
-class Fingerprint:
-    name: str
-    pattern: str
-    pattern_type: str
-    location_found: str
-    exp_url: Optional[str] = ""
-    confidence_no_fp: Optional[int] = 5
-    source: List[Optional[str]] = field(default_factory=list)
-    scope: Optional[str] = ""
-    notes: Optional[str] = ""
-    expected_countries: Optional[List[str]] = field(default_factory=list)
-    other_names: Optional[List[str]] = field(default_factory=list)
-
 def load_ooni_fp_utils():
     resp = requests.get(OO_FINGERPRINTS)
     fingerprints_block = []
@@ -110,34 +98,6 @@ def fp_to_dict(fp: Fingerprint) -> Dict[str, Any]:
     d["other_names"] = ",".join(d["other_names"])
     return d
 
-def csv_row_to_fp(row):
-    return Fingerprint(
-        name=row["name"],
-        pattern=row["pattern"],
-        pattern_type=row["pattern_type"],
-        location_found=row["location_found"],
-        confidence_no_fp=int(row["confidence_no_fp"]),
-        source=row["source"].split(","),
-        scope=row["scope"],
-        exp_url=row["exp_url"],
-        notes=row["notes"],
-        expected_countries=row["expected_countries"].split(","),
-        other_names=row["other_names"].split(","),
-    )
-
-def load_existing_fps():
-    fingerprints = []
-    with open("fingerprints_http.csv", "r", encoding="utf-8", newline="") as in_file:
-        reader = csv.DictReader(in_file)
-        for row in reader:
-            fingerprints.append(csv_row_to_fp(row))
-
-    with open("fingerprints_dns.csv", "r", encoding="utf-8", newline="") as in_file:
-        reader = csv.DictReader(in_file)
-        for row in reader:
-            fingerprints.append(csv_row_to_fp(row))
-    return fingerprints
-
 def main():
     fingerprints = load_existing_fps()
 
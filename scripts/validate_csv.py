@@ -2,10 +2,17 @@
 """
 Validate CSV files
 """
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass, field
 from pathlib import Path
-from typing import TypedDict
+from typing import Dict, List, Optional
+import argparse
 import csv
+import json
+import re
 import sys
+import time
 
 SCOPES = ("isp", "nat", "prod", "inst", "fp", "vbw", "injb", "prov")
 CCS = set(
@@ -263,76 +270,209 @@ CCS = set(
 )
 CCS.add("ZZ")  # ZZ is allowed in expected_countries
 
+LOCATIONS = ("body", "dns")
+PATTERN_TYPES = ("full", "prefix", "contains", "regexp")
 
-class Fingerprint(TypedDict):
-    name: str
-    scope: str
-    other_names: str
-    location_found: str
-    pattern_type: str
-    pattern: str
-    confidence_no_fp: int
-    expected_countries: list
+# Names which are already used by one fingerprint in each CSV file. They are
+# reported as warnings so that CI keeps passing until they are renamed, any
+# other duplicate name is an error.
+KNOWN_DUPLICATE_NAMES = ("ooni.id_39", "ooni.th_9", "ooni.th_10")
 
+# (name, alias) pairs where other_names lists the name of a different
+# fingerprint. Like KNOWN_DUPLICATE_NAMES they are only reported as warnings.
+KNOWN_ALIAS_COLLISIONS = (("ooni.ru_0", "cp.f_gen_ru_3"),)
 
-def validate_row(pos, row, header) -> None:
-    assert len(row) == len(
-        header
-    ), f"""{pos} Inconsistent row count in {row}
-        expected {len(header)} got {len(row)}"""
+# Below this number of regexps compiling them inline is faster than starting
+# a worker pool
+POOL_MIN_REGEXPS = 200
 
-    r = Fingerprint(zip(header, row))
+
+@dataclass
+class ValidationError:
+    path: str
+    line: int
+    message: str
+
+    def __str__(self):
+        return f"{self.path}:{self.line} {self.message}"
+
+
+@dataclass
+class ValidationResult:
+    errors: List[ValidationError] = field(default_factory=list)
+    warnings: List[ValidationError] = field(default_factory=list)
+    rows: int = 0
+    timing: Dict[str, float] = field(default_factory=dict)
+
+    @property
+    def ok(self) -> bool:
+        return not self.errors
+
+    def to_json(self) -> str:
+        return json.dumps(
+            dict(
+                ok=self.ok,
+                rows=self.rows,
+                errors=[asdict(e) for e in self.errors],
+                warnings=[asdict(w) for w in self.warnings],
+                timing=self.timing,
+            ),
+            indent=2,
+        )
+
+
+def validate_row(r: Dict[str, str]) -> List[str]:
+    errors = []
+    if r["scope"] not in SCOPES:
+        errors.append(f"""Invalid scope '{r["scope"]}'""")
+    if not r["pattern"]:
+        errors.append("Empty pattern")
+
+    loc = r["location_found"]
+    if loc not in LOCATIONS and not loc.startswith("header."):
+        errors.append(f"Invalid location '{loc}'")
+
+    pt = r["pattern_type"]
+    if pt not in PATTERN_TYPES:
+        errors.append(f"Invalid pattern_type '{pt}'")
+
+    ec = r["expected_countries"]
+    if ec != ec.strip():
+        errors.append("Spaces or newlines around expected_countries")
+    elif ec:
+        for cc in ec.split(","):
+            if cc == "":
+                errors.append(f"Spurious commas in expected_countries {repr(ec)}")
+            elif cc not in CCS:
+                errors.append(f"Unexpected CC '{cc}'")
+    return errors
+
+
+def compile_regexp(pattern: str) -> Optional[str]:
     try:
-        assert r["scope"] in SCOPES, f"""Invalid scope '{r["scope"]}'"""
-        assert r["pattern"], "Empty pattern"
-        loc = r["location_found"]
-        assert loc in ("body", "dns") or loc.startswith(
-            "header."
-        ), f"Invalid location '{loc}'"
-
-        pt = r["pattern_type"]
-        assert pt in (
-            "full",
-            "prefix",
-            "contains",
-            "regexp",
-        ), f"Invalid pattern_type '{pt}'"
-
-        ec = r["expected_countries"]
-        assert ec == ec.strip(), "Spaces or newlines around expected_countries"
-        if ec == "":
-            ccs = []
-        else:
-            ccs = ec.split(",")
-        assert "" not in ccs, f"Spurious commas in expected_countries {repr(ec)}"
-        for cc in ccs:
-            assert cc in CCS, f"Unexpected CC '{cc}'"
-
-    except AssertionError as e:
-        print(f"--- error in {pos} ---")
-        print(e)
-        print(f"---\n{r}\n---")
-        print("=== Validation failed ===")
-        sys.exit(1)
-    return r["name"]
+        re.compile(pattern)
+    except re.error as e:
+        return f"Invalid regexp {repr(pattern)}: {e}"
+    return None
+
+
+def check_names(result: ValidationResult, names: Dict[str, list], aliases: Dict[str, list]):
+    """
+    Names must be unique across both files, except for KNOWN_DUPLICATE_NAMES,
+    and an alias listed in other_names must not be listed twice nor be the
+    name of any fingerprint, except for KNOWN_ALIAS_COLLISIONS
+    """
+    for name, positions in names.items():
+        known = name in KNOWN_DUPLICATE_NAMES and len(set(p for p, _ in positions)) == len(positions)
+        for path, line in positions[1:]:
+            first = "{}:{}".format(*positions[0])
+            report = result.warnings if known else result.errors
+            report.append(
+                ValidationError(path, line, f"Duplicate fingerprint name {name}, first seen in {first}")
+            )
+    for alias, positions in aliases.items():
+        for path, line, name in positions:
+            if alias == name:
+                result.errors.append(ValidationError(path, line, f"Fingerprint {name} lists itself in other_names"))
+            elif alias in names:
+                first = "{}:{}".format(*names[alias][0])
+                report = result.warnings if (name, alias) in KNOWN_ALIAS_COLLISIONS else result.errors
+                report.append(
+                    ValidationError(path, line, f"other_names entry {alias} is the name of the fingerprint in {first}")
+                )
+        for path, line, name in positions[1:]:
+            result.errors.append(
+                ValidationError(path, line, f"other_names entry {alias} is also listed by {positions[0][2]}")
+            )
+
+
+def validate_csvs(csv_paths: List[Path], jobs: Optional[int] = None) -> ValidationResult:
+    result = ValidationResult()
+    names = defaultdict(list)
+    aliases = defaultdict(list)
+    regexps = []
 
+    t0 = time.perf_counter()
+    for csv_path in csv_paths:
+        path = str(csv_path)
+        with csv_path.open(encoding="utf-8", newline="") as in_file:
+            reader = csv.reader(in_file)
+            header = next(reader)
+            line = reader.line_num + 1
+            for row in reader:
+                result.rows += 1
+                if len(row) != len(header):
+                    result.errors.append(
+                        ValidationError(
+                            path, line, f"Inconsistent row count expected {len(header)} got {len(row)}"
+                        )
+                    )
+                else:
+                    r = dict(zip(header, row))
+                    for message in validate_row(r):
+                        result.errors.append(ValidationError(path, line, message))
 
-def validate_csv(csv_path: Path):
-    fp_names = set()
-    with csv_path.open() as in_file:
-        reader = csv.reader(in_file)
-        header = next(reader)
-        for idx, row in enumerate(reader):
-            pos = f"{csv_path}:{idx+1}"
-            fp_name = validate_row(pos, row, header)
-            assert fp_name not in fp_names, f"{pos} Duplicate fingerprint name {fp_name}"
-            fp_names.add(fp_name)
+                    names[r["name"]].append((path, line))
+                    for alias in r["other_names"].split(","):
+                        if alias:
+                            aliases[alias].append((path, line, r["name"]))
+                    if r["pattern_type"] == "regexp":
+                        regexps.append((path, line, r["pattern"]))
+                line = reader.line_num + 1
+    t1 = time.perf_counter()
+
+    check_names(result, names, aliases)
+    t2 = time.perf_counter()
+
+    patterns = [pattern for _, _, pattern in regexps]
+    if len(patterns) < POOL_MIN_REGEXPS:
+        regexp_errors = list(map(compile_regexp, patterns))
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            regexp_errors = list(executor.map(compile_regexp, patterns, chunksize=64))
+    for (path, line, _), message in zip(regexps, regexp_errors):
+        if message:
+            result.errors.append(ValidationError(path, line, message))
+    t3 = time.perf_counter()
+
+    result.errors.sort(key=lambda e: (e.path, e.line))
+    result.warnings.sort(key=lambda w: (w.path, w.line))
+    result.timing = dict(
+        read_rows=t1 - t0,
+        check_names=t2 - t1,
+        compile_regexps=t3 - t2,
+        total=t3 - t0,
+    )
+    return result
 
 
 def main():
-    validate_csv(Path("fingerprints_dns.csv"))
-    validate_csv(Path("fingerprints_http.csv"))
-    print("Validation successful")
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--json", action="store_true", help="print the result as JSON")
+    parser.add_argument("--jobs", type=int, default=None, help="workers used to compile regexps")
+    parser.add_argument(
+        "csv_paths",
+        nargs="*",
+        type=Path,
+        default=[Path("fingerprints_dns.csv"), Path("fingerprints_http.csv")],
+    )
+    args = parser.parse_args()
+
+    result = validate_csvs(args.csv_paths, jobs=args.jobs)
+    if args.json:
+        print(result.to_json())
+    else:
+        for w in result.warnings:
+            print(f"warning: {w}")
+        for e in result.errors:
+            print(e)
+        print(f"Checked {result.rows} rows in {result.timing['total']:.3f}s")
+        if result.ok:
+            print("Validation successful")
+        else:
+            print(f"=== Validation failed with {len(result.errors)} errors ===")
+    if not result.ok:
+        sys.exit(1)
 
 
 if __name__ == "__main__":